@@ -3,14 +3,25 @@ Lab Intelligence Chatbot - Streamlit Frontend
 Natural language interface for querying lab database
 """
 
+from __future__ import annotations
+
 import streamlit as st
 import requests
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import json
 import os
+import hashlib
+import io
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 try:
     from dotenv import load_dotenv
@@ -18,6 +29,16 @@ try:
 except ImportError:
     pass  # dotenv is optional for frontend
 
+try:
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    # orjson is optional; fall back to the stdlib parser
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
 # Page configuration
 st.set_page_config(
     page_title="Lab Intelligence Chatbot",
@@ -43,40 +64,365 @@ API_TIMEOUT = st.sidebar.slider(
     help="Maximum time to wait for API response"
 )
 
+# Upper bound on points sent to the browser per line chart
+MAX_CHART_POINTS = 2000
+# Line charts with more points than this are drawn with WebGL instead of SVG
+WEBGL_POINT_THRESHOLD = 1000
+# Most recent turns (a question plus its answer, if any) kept in the session
+MAX_HISTORY = 20
+# Per-result caches (frames, CSV bytes, figures) are shared by every session;
+# size them for about MAX_HISTORY results per session across this many sessions
+EXPECTED_SESSIONS = 10
+RESULT_CACHE_ENTRIES = MAX_HISTORY * EXPECTED_SESSIONS
+# Seconds a per-result cache entry lives before it is rebuilt
+RESULT_CACHE_TTL = 3600
+# Rows per page of a result table
+TABLE_PAGE_SIZE = 200
+# Seconds a health probe result is reused before probing again
+HEALTH_TTL = 10
+# Seconds the end of a script run waits for a pending health probe
+HEALTH_WAIT = 3
+# Minimum seconds between repaints of a streaming answer
+STREAM_PAINT_INTERVAL = 0.05
+
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "query_history" not in st.session_state:
     st.session_state.query_history = []
+if "http" not in st.session_state:
+    # Keep-alive session so reruns reuse the TCP/TLS connection to the backend
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        # Connection failures are retried for every method, but urllib3's default
+        # allowed_methods leaves out POST, so a 5xx from /ask is never replayed:
+        # each /ask runs a fresh LLM call and is not idempotent
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+    st.session_state.http = session
+
+
+class MemoryCache:
+    """Process-local stand-in for diskcache.Cache when diskcache is not installed"""
+
+    def __init__(self):
+        self._items = {}
 
+    def get(self, key):
+        value, expires_at = self._items.get(key, (None, 0))
+        return value if time.monotonic() < expires_at else None
 
-def call_api(question: str) -> dict:
-    """Call the backend API"""
+    def set(self, key, value, expire):
+        self._items[key] = (value, time.monotonic() + expire)
+
+
+@st.cache_resource
+def get_answer_cache():
+    """Open the response cache shared across sessions"""
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/ask",
-            json={"question": question},
-            timeout=API_TIMEOUT
-        )
+        import diskcache
+    except ImportError:
+        return MemoryCache()  # diskcache is optional; answers then live in memory only
+    return diskcache.Cache(".api_cache")
+
+
+def read_event_stream(response: requests.Response, placeholder) -> dict:
+    """Assemble an /ask result from server-sent events, painting answer tokens as they arrive"""
+    # Only a closing "done" frame marks the answer complete (and cacheable)
+    result = {"success": False, "answer": "", "sql_query": "", "data": [],
+              "error": "Response stream ended before the answer was complete"}
+    chunks = []
+    last_paint = 0.0
+    # SSE is always UTF-8; requests would otherwise assume ISO-8859-1 for text/* without a charset
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        try:
+            event = json_loads(line[5:])
+            kind = event.pop("kind", None)
+        except (ValueError, AttributeError):
+            result["error"] = "Malformed event in response stream"
+            break
+        if kind == "token":
+            chunks.append(str(event.get("text", "")))
+            # Batch repaints so a fast stream doesn't flood the frontend
+            now = time.monotonic()
+            if now - last_paint >= STREAM_PAINT_INTERVAL:
+                placeholder.markdown("".join(chunks))
+                last_paint = now
+        elif kind == "sql":
+            result["sql_query"] = event.get("sql", "")
+        elif kind == "rows":
+            rows = event.get("rows") or []
+            if not isinstance(rows, list):
+                result["error"] = "Malformed event in response stream"
+                break
+            result["data"].extend(rows)
+        elif kind == "error":
+            result["error"] = event.get("error", "Unknown error")
+            break
+        elif kind == "done":
+            result.update(event)  # e.g. execution_time_ms, row_count
+            result["success"] = True
+            result.pop("error", None)
+            break
+    result["answer"] = "".join(chunks)
+    return result
+
+
+def fetch_answer(question: str, placeholder) -> dict:
+    """POST a question to the backend, streaming the answer when the backend supports it"""
+    with st.session_state.http.post(
+        f"{API_BASE_URL}/ask",
+        data=json_dumps({"question": question}),
+        headers={"Accept": "text/event-stream, application/json", "Content-Type": "application/json"},
+        timeout=API_TIMEOUT,
+        stream=True
+    ) as response:
         response.raise_for_status()
-        return response.json()
+        if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+            return read_event_stream(response, placeholder)
+        return json_loads(response.content)
+
+
+def call_api(question: str, placeholder) -> dict:
+    """Call the backend API, reusing cached answers for repeat questions"""
+    cache = get_answer_cache()
+    key = hashlib.sha256(f"{API_BASE_URL}|{question}".encode()).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        result = fetch_answer(question, placeholder)
     except requests.exceptions.Timeout:
         st.error(f"⏱️ API Timeout: Request took longer than {API_TIMEOUT} seconds. Try increasing the timeout in the sidebar.")
         return None
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
         return None
+    except ValueError as e:
+        st.error(f"API Error: invalid JSON in response ({str(e)})")
+        return None
+
+    # Only successful answers are worth replaying
+    if result.get("success"):
+        cache.set(key, result, expire=3600)
+    return result
 
 
-def check_api_health() -> bool:
+def check_api_health(url: str, session: requests.Session) -> bool:
     """Check if API is healthy"""
     try:
-        response = requests.get(f"{API_BASE_URL}/health", timeout=5)
+        response = session.get(f"{url}/health", timeout=2)
         return response.status_code == 200
     except:
         return False
 
 
+class HealthProbes:
+    """Background /health probes shared by all sessions, one per URL every HEALTH_TTL seconds"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # Keep-alive session without retries, so a probe gives up after one timeout
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._probes = {}
+
+    def status(self, url: str) -> tuple:
+        """Return the last completed result for url (None before the first) and the latest probe"""
+        with self._lock:
+            probe = self._probes.setdefault(url, {"started": 0.0, "future": None, "healthy": None})
+            future = probe["future"]
+            if future is not None and future.done():
+                probe["healthy"] = future.result()
+            if future is None or time.monotonic() - probe["started"] > HEALTH_TTL:
+                probe["future"] = self._executor.submit(check_api_health, url, self._session)
+                probe["started"] = time.monotonic()
+            return probe["healthy"], probe["future"]
+
+
+@st.cache_resource
+def get_health_probes() -> HealthProbes:
+    """Process-wide probe registry, so sessions reuse each other's results"""
+    return HealthProbes()
+
+
+def show_api_health(slot, healthy: bool):
+    """Render the health probe result into its sidebar slot"""
+    with slot.container():
+        if healthy:
+            st.success("✅ API Connected")
+        else:
+            st.error("❌ API Not Available")
+            st.info(f"Please ensure the backend is running at {API_BASE_URL}")
+
+
+@st.cache_resource(show_spinner=False)
+def viz_modules():
+    """Import pandas and plotly on first use; only result tables and charts need them"""
+    import pandas as pd
+    import plotly.express as px
+    import plotly.graph_objects as go
+    return pd, px, go
+
+
+def downsample_points(points: pd.DataFrame, x_col: str, y_col: str, n_out: int = MAX_CHART_POINTS) -> pd.DataFrame:
+    """Reduce a series sorted by x_col to at most n_out rows while keeping its visual shape"""
+    if len(points) <= n_out:
+        return points
+    try:
+        from tsdownsample import MinMaxLTTBDownsampler
+        # Pass x so gaps (days without rows) are weighted by their real spacing
+        x = points[x_col].astype("int64").to_numpy()
+        idx = MinMaxLTTBDownsampler().downsample(x, points[y_col].to_numpy(), n_out=n_out)
+    except ImportError:
+        # tsdownsample is optional; fall back to evenly strided points
+        idx = slice(None, None, -(-len(points) // n_out))
+    return points.iloc[idx]
+
+
+def line_render_mode(n_points: int) -> str:
+    """Pick WebGL (scattergl) traces for large line charts, SVG otherwise"""
+    return "webgl" if n_points > WEBGL_POINT_THRESHOLD else "svg"
+
+
+def count_by_day(values: pd.Series) -> pd.DataFrame:
+    """Count rows per calendar day in a single vectorized pass"""
+    pd, _, _ = viz_modules()
+    parsed = pd.to_datetime(values, errors="coerce")
+    if parsed.notna().mean() < 0.5:
+        parsed = parsed.iloc[:0]  # mostly unparseable, so not treated as a date column
+    days = parsed.dt.floor("D")
+    return days.value_counts().sort_index().rename_axis(values.name).reset_index(name="count")
+
+
+def data_hash(data: list) -> str:
+    """Short content hash of a result set, used to key per-result caches"""
+    return hashlib.blake2b(json.dumps(data, default=str).encode(), digest_size=8).hexdigest()
+
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_ENTRIES, show_spinner=False)
+def to_dataframe(data_key: str, _data: list) -> pd.DataFrame:
+    """Build a result frame once; later reruns reuse it by content hash"""
+    pd, _, _ = viz_modules()
+    return pd.DataFrame(_data)
+
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_ENTRIES, show_spinner=False)
+def csv_bytes(data_key: str, _data: list) -> bytes:
+    """Encode a result frame as CSV once per distinct result"""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    df = to_dataframe(data_key, _data)
+    buf = io.BytesIO()
+    try:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    except pa.ArrowException:
+        # Mixed-type columns Arrow can't type, or list/struct columns its CSV
+        # writer can't format; fall back to the pandas writer
+        return df.to_csv(index=False).encode()
+    return buf.getvalue()
+
+
+def is_low_cardinality(values: pd.Series) -> bool:
+    """Whether a column has few enough distinct values for a distribution chart"""
+    try:
+        return values.nunique(dropna=False) < 20
+    except TypeError:
+        return False  # unhashable values, e.g. JSON arrays or objects from the backend
+
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_ENTRIES, show_spinner=False)
+def build_charts(data_key: str, _data: list) -> tuple:
+    """Build a result's trend and distribution charts once, as JSON figure specs"""
+    _, px, _ = viz_modules()
+    df = to_dataframe(data_key, _data)
+    date_col = None
+    date_fig = None
+    bar_fig = None
+
+    # Trend over time for time-series data
+    if "bill_date" in df.columns or "date" in [col.lower() for col in df.columns]:
+        date_col = "bill_date" if "bill_date" in df.columns else [col for col in df.columns if "date" in col.lower()][0]
+        try:
+            # Count by date
+            date_counts = count_by_day(df[date_col])
+            if date_counts.empty:
+                date_col = None  # didn't parse as dates; leave it to the categorical charts
+            elif len(date_counts) > 1:
+                date_counts = downsample_points(date_counts, date_col, "count")
+                fig = px.line(date_counts, x=date_col, y="count",
+                              title="Trend Over Time", markers=True,
+                              render_mode=line_render_mode(len(date_counts)))
+                date_fig = fig.to_json()
+        except:
+            date_col = None
+
+    # Bar charts for categorical data
+    object_cols = df.select_dtypes(include="object").columns.drop(date_col, errors="ignore")
+    categorical_cols = [col for col in object_cols if is_low_cardinality(df[col])][:2]  # Limit to 2 charts
+    distributions = {}
+    for cat_col in categorical_cols:
+        try:
+            distributions[cat_col] = df[cat_col].value_counts().head(10)
+        except:
+            pass
+    if distributions:
+        # One figure with a subplot per column, so Plotly initializes once
+        from plotly.subplots import make_subplots
+
+        fig = make_subplots(rows=1, cols=len(distributions),
+                            subplot_titles=[f"Distribution: {col}" for col in distributions])
+        for i, (cat_col, counts) in enumerate(distributions.items(), start=1):
+            fig.add_bar(x=counts.index, y=counts.values, name=cat_col, row=1, col=i)
+            fig.update_xaxes(title_text=cat_col, row=1, col=i)
+            fig.update_yaxes(title_text="Count", row=1, col=i)
+        fig.update_layout(showlegend=False)
+        bar_fig = fig.to_json()
+
+    return date_fig, bar_fig
+
+
+def show_table_page(df: pd.DataFrame, key: str):
+    """Send only one page of a result table to the browser"""
+    pages = max(1, -(-len(df) // TABLE_PAGE_SIZE))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"page_{key}")
+    start = (page - 1) * TABLE_PAGE_SIZE
+    st.dataframe(df.iloc[start:start + TABLE_PAGE_SIZE], use_container_width=True, height=400)
+
+
+def show_charts(data_key: str, data: list, key: str):
+    """Render a result's auto-generated charts from the per-result figure cache"""
+    _, _, go = viz_modules()
+    date_fig, bar_fig = build_charts(data_key, data)
+    # Keyed per message: identical results in two messages would otherwise collide
+    if date_fig:
+        st.plotly_chart(go.Figure(json.loads(date_fig)), use_container_width=True, key=f"trend_{key}")
+    if bar_fig:
+        with st.expander("📊 Visualizations"):
+            st.plotly_chart(go.Figure(json.loads(bar_fig)), use_container_width=True, key=f"bars_{key}")
+
+
+def trim_history():
+    """Drop the oldest turns beyond MAX_HISTORY so the per-rerun history loop stays bounded"""
+    # A turn starts at a user message; failed calls leave the question without an answer
+    turn_starts = [i for i, message in enumerate(st.session_state.messages) if message["role"] == "user"]
+    if len(turn_starts) > MAX_HISTORY:
+        st.session_state.messages = st.session_state.messages[turn_starts[-MAX_HISTORY]:]
+    st.session_state.query_history = st.session_state.query_history[-MAX_HISTORY:]
+
+
 # Main UI
 st.title("🧪 Lab Intelligence Chatbot")
 st.markdown("Ask questions about lab data in natural language and get instant insights!")
@@ -86,11 +432,14 @@ with st.sidebar:
     st.header("⚙️ Configuration")
     
     # Health check
-    if check_api_health():
-        st.success("✅ API Connected")
+    # Show the last known status while a refresh runs; "Checking" only before the first result
+    healthy, health = get_health_probes().status(API_BASE_URL)
+    health_slot = st.empty()
+    health_shown = healthy is not None
+    if health_shown:
+        show_api_health(health_slot, healthy)
     else:
-        st.error("❌ API Not Available")
-        st.info(f"Please ensure the backend is running at {API_BASE_URL}")
+        health_slot.info("⏳ Checking API…")
     
     st.divider()
     
@@ -116,8 +465,9 @@ with st.sidebar:
         st.rerun()
 
 # Display chat history
-chat_container = st.container()
-with chat_container:
+@st.fragment
+def history_view():
+    """Render the chat history; widget interactions inside it rerun only this region"""
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
@@ -129,7 +479,7 @@ with chat_container:
             
             # Show data table if available
             if message.get("data") and len(message["data"]) > 0:
-                df = pd.DataFrame(message["data"])
+                df = to_dataframe(message["data_hash"], message["data"])
                 
                 # Display summary
                 col1, col2, col3 = st.columns(3)
@@ -142,37 +492,22 @@ with chat_container:
                         st.metric("Execution Time", f"{message['execution_time_ms']:.0f}ms")
                 
                 # Display table
-                st.dataframe(df, use_container_width=True, height=400)
+                show_table_page(df, message["id"])
+                st.download_button(
+                    label="📥 Download as CSV",
+                    data=csv_bytes(message["data_hash"], message["data"]),
+                    file_name=f"lab_query_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv",
+                    key=f"download_{message['id']}"
+                )
                 
-                # Auto-generate visualizations for time-series data
-                if "bill_date" in df.columns or "date" in [col.lower() for col in df.columns]:
-                    date_col = "bill_date" if "bill_date" in df.columns else [col for col in df.columns if "date" in col.lower()][0]
-                    try:
-                        df[date_col] = pd.to_datetime(df[date_col])
-                        
-                        # Count by date
-                        if len(df) > 1:
-                            date_counts = df.groupby(df[date_col].dt.date).size().reset_index(name="count")
-                            fig = px.line(date_counts, x=date_col, y="count", 
-                                        title="Trend Over Time", markers=True)
-                            st.plotly_chart(fig, use_container_width=True)
-                    except:
-                        pass
-                
-                # Generate bar chart for categorical data
-                categorical_cols = [col for col in df.columns 
-                                  if df[col].dtype == 'object' and len(df[col].unique()) < 20]
-                if categorical_cols and len(df) > 0:
-                    with st.expander("📊 Visualizations"):
-                        for cat_col in categorical_cols[:2]:  # Limit to 2 charts
-                            try:
-                                counts = df[cat_col].value_counts().head(10)
-                                fig = px.bar(x=counts.index, y=counts.values,
-                                           title=f"Distribution: {cat_col}",
-                                           labels={"x": cat_col, "y": "Count"})
-                                st.plotly_chart(fig, use_container_width=True)
-                            except:
-                                pass
+                # Auto-generated visualizations, computed once per message
+                show_charts(message["data_hash"], message["data"], message["id"])
+
+
+chat_container = st.container()
+with chat_container:
+    history_view()
 
 # Chat input
 if "current_question" in st.session_state:
@@ -183,7 +518,7 @@ else:
 
 if question:
     # Add user message to history
-    st.session_state.messages.append({"role": "user", "content": question})
+    st.session_state.messages.append({"id": uuid.uuid4().hex, "role": "user", "content": question})
     
     # Display user message
     with st.chat_message("user"):
@@ -191,20 +526,23 @@ if question:
     
     # Show assistant thinking
     with st.chat_message("assistant"):
+        answer_placeholder = st.empty()
         with st.spinner("Analyzing your question and querying the database..."):
-            result = call_api(question)
+            result = call_api(question, answer_placeholder)
         
         if result:
             if result.get("success"):
                 # Display answer
-                st.markdown(result.get("answer", "Query executed successfully."))
+                answer_placeholder.markdown(result.get("answer", "Query executed successfully."))
                 
                 # Store in session
                 message_data = {
+                    "id": uuid.uuid4().hex,
                     "role": "assistant",
                     "content": result.get("answer", ""),
                     "sql_query": result.get("sql_query", ""),
                     "data": result.get("data", []),
+                    "data_hash": data_hash(result.get("data", [])),
                     "execution_time_ms": result.get("execution_time_ms", 0),
                     "row_count": result.get("row_count", 0)
                 }
@@ -215,14 +553,15 @@ if question:
                     "timestamp": datetime.now().isoformat()
                 })
                 
-                # Display SQL
-                with st.expander("📝 View SQL Query"):
-                    st.code(result.get("sql_query", ""), language="sql")
+                # Display SQL if available
+                if message_data["sql_query"]:
+                    with st.expander("📝 View SQL Query"):
+                        st.code(message_data["sql_query"], language="sql")
                 
                 # Display data
                 data = result.get("data", [])
                 if len(data) > 0:
-                    df = pd.DataFrame(data)
+                    df = to_dataframe(message_data["data_hash"], data)
                     
                     # Metrics
                     col1, col2, col3 = st.columns(3)
@@ -233,31 +572,11 @@ if question:
                     with col3:
                         st.metric("Execution Time", f"{result.get('execution_time_ms', 0):.0f}ms")
                     
-                    # Data table
-                    st.dataframe(df, use_container_width=True, height=400)
-                    
-                    # Download button
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        label="📥 Download as CSV",
-                        data=csv,
-                        file_name=f"lab_query_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                        mime="text/csv"
-                    )
+                    # Data table; the download button is offered by the history view after the rerun
+                    show_table_page(df, message_data["id"])
                     
-                    # Auto-visualizations
-                    if "bill_date" in df.columns:
-                        try:
-                            df_date = df.copy()
-                            df_date["bill_date"] = pd.to_datetime(df_date["bill_date"])
-                            date_counts = df_date.groupby(df_date["bill_date"].dt.date).size().reset_index(name="count")
-                            
-                            if len(date_counts) > 1:
-                                fig = px.line(date_counts, x="bill_date", y="count",
-                                            title="📈 Trend Over Time", markers=True)
-                                st.plotly_chart(fig, use_container_width=True)
-                        except Exception as e:
-                            pass
+                    # Auto-visualizations; warms the cache the history view reuses
+                    show_charts(message_data["data_hash"], data, message_data["id"])
                 else:
                     st.info("No data returned from query.")
             else:
@@ -265,6 +584,7 @@ if question:
         else:
             st.error("Failed to connect to API. Please check your configuration.")
     
+    trim_history()
     st.rerun()
 
 # Footer
@@ -278,3 +598,10 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+# Fill in the health status once the background probe finishes
+if not health_shown:
+    try:
+        show_api_health(health_slot, health.result(timeout=HEALTH_WAIT))
+    except FutureTimeoutError:
+        pass  # leave "Checking API…" up; the next rerun picks up the result
+